@@ -1,39 +1,262 @@
+import asyncio
+import contextvars
+import cProfile
+import csv
+import io
+import itertools
 import json
+import math
 import os
+import pstats
+import random
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import UTC, date, datetime, timedelta
 
+import pytz
 import requests
-from fastapi import FastAPI, HTTPException
+from cachetools import LRUCache, TLRUCache, TTLCache
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 
 today = date.today()
 
 app = FastAPI()
 
-cachedPrices = {}
+# Prices per GLN and day. Empty results (unknown GLN, tomorrow not published yet, upstream errors) expire sooner, so they are retried.
+priceCacheTtlSeconds = float(os.getenv('PRICE_CACHE_TTL_SECONDS', '172800'))
+emptyPriceRetrySeconds = float(os.getenv('EMPTY_PRICE_RETRY_SECONDS', '900'))
+cachedPrices = TLRUCache(maxsize=int(os.getenv('PRICE_CACHE_MAX_ENTRIES', '8192')),
+                         ttu=lambda key, value, now: now + (priceCacheTtlSeconds if value else emptyPriceRetrySeconds))
+cachedPricesLock = threading.Lock()
+priceFetchLocks = [threading.Lock() for _ in range(64)]
+optimalWindowTables = LRUCache(maxsize=256)
+
+# On-demand profiling. The middleware is only installed when PROFILING_ENABLED is set, so it costs nothing otherwise.
+profilingEnabled = os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes')
+profilingSampleRate = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+profilingAdminToken = os.getenv('PROFILING_ADMIN_TOKEN', '')
+profilingWindowSeconds = int(os.getenv('PROFILING_WINDOW_SECONDS', '300'))
+profileSamples = deque(maxlen=int(os.getenv('PROFILING_MAX_SAMPLES', '200')))
+profileIds = itertools.count(1)
+profilingActive = False
+# Seconds spent per phase of the request being profiled. None for requests that aren't profiled.
+requestPhases = contextvars.ContextVar('requestPhases', default=None)
+
+upstreamTimeoutSeconds = float(os.getenv('UPSTREAM_TIMEOUT_SECONDS', '10'))
+
+# Backtest days are fetched upstream concurrently on one long-lived, bounded pool shared by all backtests.
+backtestMaxDays = int(os.getenv('BACKTEST_MAX_DAYS', '366'))
+backtestFetchExecutor = ThreadPoolExecutor(max_workers=int(os.getenv('BACKTEST_FETCH_WORKERS', '8')),
+                                           thread_name_prefix='backtest-fetch')
+# Upstream days, and the start hour of a backtest, are in Danish local time.
+backtestTimezone = pytz.timezone('Europe/Copenhagen')
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token. Returns 0 on success, otherwise the seconds until a token is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated)*self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """Bounds the requests being worked on, with a bounded FIFO queue of waiters behind them."""
+    def __init__(self, maxInFlight, maxQueued):
+        self.maxInFlight = maxInFlight
+        self.maxQueued = maxQueued
+        self.inFlight = 0
+        self.waiters = deque()
+
+    async def acquire(self):
+        """Wait for a slot. Returns False without waiting if the queue is full."""
+        if self.inFlight < self.maxInFlight and not self.waiters:
+            self.inFlight += 1
+            return True
+        if len(self.waiters) >= self.maxQueued:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed to us just before cancellation; pass it on.
+                self.release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+        return True
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                # Hand the slot straight to the next waiter, so inFlight is unchanged.
+                waiter.set_result(None)
+                return
+        self.inFlight -= 1
+
+
+# Admission control for the optimisation and backtest endpoints. Buckets are kept in TTL caches so random keys can't grow them unbounded.
+# Behind a proxy, CLIENT_IP_HEADER names the header it puts the client address in (e.g. X-Forwarded-For); the last entry is used.
+clientIpHeader = os.getenv('CLIENT_IP_HEADER', '')
+clientRatePerSecond = float(os.getenv('CLIENT_RATE_PER_SECOND', '5'))
+clientBurst = int(os.getenv('CLIENT_BURST', '20'))
+glnRatePerSecond = float(os.getenv('GLN_RATE_PER_SECOND', '5'))
+glnBurst = int(os.getenv('GLN_BURST', '20'))
+clientBuckets = TTLCache(maxsize=10000, ttl=600)
+glnBuckets = TTLCache(maxsize=10000, ttl=600)
+uncachedGlnFetchesPerInterval = int(os.getenv('UNCACHED_GLN_FETCHES_PER_INTERVAL', '10'))
+uncachedGlnIntervalSeconds = float(os.getenv('UNCACHED_GLN_INTERVAL_SECONDS', '60'))
+uncachedGlnBucket = TokenBucket(uncachedGlnFetchesPerInterval / uncachedGlnIntervalSeconds, uncachedGlnFetchesPerInterval)
+# GLN numbers that were charged, or returned prices, recently. Kept as long as their prices are cached.
+chargedGlns = TTLCache(maxsize=10000, ttl=priceCacheTtlSeconds)
+admissionRetryAfterSeconds = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', '1'))
+optimisationAdmission = AdmissionController(int(os.getenv('ADMISSION_MAX_IN_FLIGHT', '8')), int(os.getenv('ADMISSION_MAX_QUEUE', '32')))
+backtestAdmission = AdmissionController(int(os.getenv('BACKTEST_MAX_IN_FLIGHT', '2')), int(os.getenv('BACKTEST_MAX_QUEUE', '4')))
+
 
 class EnergyPrice:
-    def __init__(self, fromTs, price):
+    def __init__(self, fromTs, price, co2=None):
         self.fromTs = datetime.fromisoformat(fromTs)
         self.toTs = self.fromTs + timedelta(hours=1)
         self.price = price
+        self.co2 = co2
     def __str__(self):
         return str(self.fromTs) + " " + str(self.toTs) + " " + str(self.price)
 
+@contextmanager
+def timedPhase(phase):
+    """Add the time spent in the block to the profiled request's phase timings."""
+    phases = requestPhases.get()
+    if phases is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[phase] = phases.get(phase, 0) + time.perf_counter() - started
+
+
+def admitGlnFetch(cache_key):
+    """Charge a GLN number that hasn't been charged or returned prices recently against uncachedGlnBucket, or reject with 503."""
+    with cachedPricesLock:
+        if str(cache_key) in chargedGlns:
+            return
+        wait = uncachedGlnBucket.take()
+        if wait:
+            raise HTTPException(status_code=503, detail="Too many new GLN numbers requested, try again later",
+                                headers={'Retry-After': str(math.ceil(wait))})
+        chargedGlns[str(cache_key)] = True
+
+
+def getCachedPrices(cache_key, dateToFind):
+    """Prices for one GLN and day. Concurrent callers for the same day wait for a single upstream fetch."""
+    key = str(cache_key)+"_"+dateToFind.strftime('%m/%d/%Y')
+    with cachedPricesLock:
+        prices = cachedPrices.get(key)
+    if prices is not None:
+        return prices
+    with priceFetchLocks[hash(key) % len(priceFetchLocks)]:
+        with cachedPricesLock:
+            prices = cachedPrices.get(key)
+        if prices is None:
+            admitGlnFetch(cache_key)
+            with timedPhase('upstream'):
+                prices = getprices(dateToFind, cache_key)
+            with cachedPricesLock:
+                cachedPrices[key] = prices
+                if prices:
+                    # A GLN number with prices is known good; keep it clear of the new-GLN cap for as long as its prices are cached.
+                    chargedGlns[str(cache_key)] = True
+    return prices
+
+
 def getFuturePrices(cache_key):
-    global cachedPrices
     today = date.today()
     tomorrow = today + timedelta(days=1)
-    if str(cache_key)+"_"+today.strftime('%m/%d/%Y') not in cachedPrices:
-      cachedPrices[str(cache_key)+"_"+today.strftime('%m/%d/%Y')]= getprices(today, cache_key)
-    if (str(cache_key)+"_"+tomorrow.strftime('%m/%d/%Y') not in cachedPrices) or (not cachedPrices[str(cache_key)+"_"+tomorrow.strftime('%m/%d/%Y')]):
-      cachedPrices[str(cache_key)+"_"+tomorrow.strftime('%m/%d/%Y')]= getprices(tomorrow, cache_key)
-
     FuturePrices = []
-    FuturePrices.extend(cachedPrices[str(cache_key)+"_"+today.strftime('%m/%d/%Y')])
-    FuturePrices.extend(cachedPrices[str(cache_key)+"_"+tomorrow.strftime('%m/%d/%Y')])
+    FuturePrices.extend(getCachedPrices(cache_key, today))
+    FuturePrices.extend(getCachedPrices(cache_key, tomorrow))
     return [e for e in FuturePrices if e.toTs >= datetime.now(UTC)]
 
 
+def check_rate_limits(request, glnNumber):
+    """Take a token from the client's and the GLN's bucket, or reject with 429."""
+    clientHost = request.client.host if request.client else 'unknown'
+    if clientIpHeader and request.headers.get(clientIpHeader):
+        clientHost = request.headers[clientIpHeader].split(',')[-1].strip()
+    for buckets, key, rate, burst in ((clientBuckets, clientHost, clientRatePerSecond, clientBurst),
+                                      (glnBuckets, glnNumber, glnRatePerSecond, glnBurst)):
+        if key not in buckets:
+            buckets[key] = TokenBucket(rate, burst)
+        wait = buckets[key].take()
+        if wait:
+            raise HTTPException(status_code=429, detail="Too many requests, try again later",
+                                headers={'Retry-After': str(math.ceil(wait))})
+
+
+async def run_admitted(request, glnNumber, admission, func, *args):
+    """Apply the rate limits, then await func(*args) once admission grants a slot."""
+    check_rate_limits(request, glnNumber)
+    if not await admission.acquire():
+        raise HTTPException(status_code=503, detail="Too many requests in progress, try again later",
+                            headers={'Retry-After': str(admissionRetryAfterSeconds)})
+    try:
+        return await func(*args)
+    finally:
+        admission.release()
+
+
+def resolve_gln_number(glnNumber):
+    if glnNumber is None:
+        glnNumber = os.getenv('GLN_NUMBER')
+    if glnNumber is None or glnNumber == '':
+        raise HTTPException(status_code=500, detail="INVALID GLNNUMBER. EITHER SET IT TO VIA ENV OR PROVIDE AS PARAMETER")
+    return glnNumber
+
+
+def parse_duration(numHoursToForecast: str) -> int:
+    """Parse a duration such as '2h30m' into minutes."""
+    try:
+        hoursString = numHoursToForecast.split('h')[0]
+        minuteString = numHoursToForecast.split('h')[1].split('m')[0]
+        durationMinutes = int(hoursString)*60 + int(minuteString)
+    except (IndexError, ValueError) as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid duration '{numHoursToForecast}'. Expected format like 2h30m"
+        ) from e
+    if durationMinutes <= 0:
+        raise HTTPException(status_code=400, detail="numHoursToForecast must be a positive duration")
+    return durationMinutes
+
+
+def format_duration(durationMinutes: int) -> str:
+    return f'{durationMinutes // 60}h{durationMinutes % 60}m'
+
+
 def parse_max_start_time(max_start_time: str) -> datetime:
     try:
         max_start_dt = datetime.fromisoformat(max_start_time.replace('Z', '+00:00'))
@@ -56,139 +279,514 @@ def parse_max_start_time(max_start_time: str) -> datetime:
         ) from e
 
 
-def filter_prices_by_max_start_time(
-    future_prices: list,
-    max_start_dt: datetime,
-    hours_to_forecast_incl_partial: int
-) -> list:
-    filtered_prices = [
-        price for price in future_prices
-        if price.fromTs <= max_start_dt
-    ]
+def parse_objective(objective: str, co2Weight: float) -> float:
+    """Translate the requested objective into the weight given to CO2 (0 is price only, 1 is CO2 only)."""
+    if objective == 'price':
+        return 0.0
+    if objective == 'co2':
+        return 1.0
+    if objective == 'blend':
+        if not 0 <= co2Weight <= 1:
+            raise HTTPException(
+                status_code=400,
+                detail="co2Weight must be between 0 and 1"
+            )
+        return co2Weight
+    raise HTTPException(
+        status_code=400,
+        detail="Invalid objective. Expected one of: price, co2, blend"
+    )
 
-    if len(filtered_prices) < hours_to_forecast_incl_partial:
-        raise HTTPException(
-            status_code=400,
-            detail="Not enough available prices before max_start_time to accommodate the requested duration"
-        )
-    return filtered_prices
+
+class OptimalWindowTable:
+    """Cheapest whole-slot window for every duration over one price series.
+
+    Built in a single sweep: the window sums for duration k are the sums for
+    k-1 plus one more slot, so every duration costs one pass over the series.
+    Price and CO2 are swept together. For each duration we keep a
+    prefix-minimum index of the best start per objective, so a search
+    restricted to the first N slots (max_start_time) is a lookup too. A
+    second index skips the first slot, since a run that can't start before
+    now usually can't start at the beginning of the current slot either.
+
+    The cumulative sums double as the integral of the piecewise-constant
+    price curve, which gives the cost of any minute-resolution window in O(1).
+    Positions within the series are given in minutes from the first slot.
+
+    CO2 data may not cover every slot the prices do, as the forecast doesn't
+    reach as far. CO2 and blended searches are limited to the first run of
+    consecutive slots with CO2 data (co2Slots).
+    """
+    def __init__(self, FuturePrices):
+        prices = [e.price for e in FuturePrices]
+        co2 = [e.co2 for e in FuturePrices]
+        self.numSlots = len(prices)
+        self.originTs = FuturePrices[0].fromTs if FuturePrices else None
+        co2Start = next((i for i, c in enumerate(co2) if c is not None), self.numSlots)
+        co2End = next((i for i in range(co2Start, self.numSlots) if co2[i] is None), self.numSlots)
+        self.co2Slots = range(co2Start, co2End)
+        self.hasCo2 = len(self.co2Slots) > 0
+        co2 = [co2[i] if i in self.co2Slots else 0 for i in range(self.numSlots)]
+        self.prices = prices
+        self.co2 = co2
+        self.cumulative = [0]
+        self.cumulativeCo2 = [0]
+        for p, c in zip(prices, co2, strict=True):
+            self.cumulative.append(self.cumulative[-1] + p)
+            self.cumulativeCo2.append(self.cumulativeCo2[-1] + c)
+        self.windowSums = {'price': [()], 'co2': [()]}
+        self.bestStarts = {'price': [()], 'co2': [()]}
+        self.bestStartsFromSecond = {'price': [()], 'co2': [()]}
+        priceRow = []
+        co2Row = []
+        for numSlots in range(1, self.numSlots+1):
+            if numSlots == 1:
+                priceRow = list(prices)
+                co2Row = list(co2)
+            else:
+                priceRow = [priceRow[i] + prices[i+numSlots-1] for i in range(self.numSlots-numSlots+1)]
+                co2Row = [co2Row[i] + co2[i+numSlots-1] for i in range(self.numSlots-numSlots+1)]
+            priceBestStarts = []
+            co2BestStarts = []
+            priceBestStartsFromSecond = [0]
+            co2BestStartsFromSecond = [0]
+            priceBest = 0
+            co2Best = 0
+            priceBestFromSecond = 1
+            co2BestFromSecond = 1
+            for i in range(len(priceRow)):
+                if priceRow[i] < priceRow[priceBest]:
+                    priceBest = i
+                if co2Row[i] < co2Row[co2Best]:
+                    co2Best = i
+                priceBestStarts.append(priceBest)
+                co2BestStarts.append(co2Best)
+                if i > 0:
+                    if priceRow[i] < priceRow[priceBestFromSecond]:
+                        priceBestFromSecond = i
+                    if co2Row[i] < co2Row[co2BestFromSecond]:
+                        co2BestFromSecond = i
+                    priceBestStartsFromSecond.append(priceBestFromSecond)
+                    co2BestStartsFromSecond.append(co2BestFromSecond)
+            self.windowSums['price'].append(tuple(priceRow))
+            self.windowSums['co2'].append(tuple(co2Row))
+            self.bestStarts['price'].append(tuple(priceBestStarts))
+            self.bestStarts['co2'].append(tuple(co2BestStarts))
+            self.bestStartsFromSecond['price'].append(tuple(priceBestStartsFromSecond))
+            self.bestStartsFromSecond['co2'].append(tuple(co2BestStartsFromSecond))
+
+    def blendScales(self, co2Weight):
+        """Per-unit weights of price and CO2, each normalised by its mean over the slots with CO2 data."""
+        if co2Weight <= 0:
+            return 1, 0
+        if co2Weight >= 1:
+            return 0, 1
+        first, end = self.co2Slots.start, self.co2Slots.stop
+        meanPrice = (self.cumulative[end] - self.cumulative[first]) / (end - first)
+        meanCo2 = (self.cumulativeCo2[end] - self.cumulativeCo2[first]) / (end - first)
+        return (1-co2Weight) / (meanPrice if meanPrice > 0 else 1), co2Weight / (meanCo2 if meanCo2 > 0 else 1)
+
+    def lookup(self, numSlots, numAvailableSlots=None, co2Weight=0.0, firstStart=0):
+        """Return (startIdx, endIdx) of the best window starting no earlier than slot firstStart
+        and lying within the first numAvailableSlots slots."""
+        if numAvailableSlots is None:
+            numAvailableSlots = self.numSlots
+        lastStart = min(numAvailableSlots, self.numSlots) - numSlots
+        if numSlots < 1 or lastStart < firstStart:
+            return 0, 0
+        if (co2Weight <= 0 or co2Weight >= 1) and firstStart <= 1:
+            index = self.bestStarts if firstStart == 0 else self.bestStartsFromSecond
+            startIdx = index['co2' if co2Weight >= 1 else 'price'][numSlots][lastStart]
+        else:
+            priceScale, co2Scale = self.blendScales(co2Weight)
+            priceSums = self.windowSums['price'][numSlots]
+            co2Sums = self.windowSums['co2'][numSlots]
+            startIdx = min(range(firstStart, lastStart+1), key=lambda i: priceScale*priceSums[i] + co2Scale*co2Sums[i])
+        return startIdx, startIdx+numSlots-1
+
+    def averagePrice(self, numSlots, startIdx):
+        return self.windowSums['price'][numSlots][startIdx] / numSlots
+
+    def averageCo2(self, numSlots, startIdx):
+        return self.windowSums['co2'][numSlots][startIdx] / numSlots
+
+    def minutesFromOrigin(self, ts):
+        return (ts - self.originTs).total_seconds() / 60
+
+    def earliestStartMinute(self, now):
+        """First whole minute a run can start: now if it falls within the first slot, otherwise the start of the series."""
+        if self.originTs is None:
+            return 0
+        offset = math.ceil(self.minutesFromOrigin(now))
+        return offset if 0 < offset <= 60 else 0
+
+    def _integral(self, cumulative, values, minute):
+        minute = min(max(minute, 0), 60*self.numSlots)
+        slot = min(int(minute // 60), self.numSlots-1)
+        return cumulative[slot] + values[slot]*(minute - 60*slot)/60
+
+    def priceCost(self, startMinute, durationMinutes):
+        """Price integrated over [startMinute, startMinute+durationMinutes), in price-hours. Truncated at the end of the series."""
+        if self.numSlots == 0:
+            return 0
+        return (self._integral(self.cumulative, self.prices, startMinute+durationMinutes)
+                - self._integral(self.cumulative, self.prices, startMinute))
+
+    def co2Cost(self, startMinute, durationMinutes):
+        if self.numSlots == 0:
+            return 0
+        return (self._integral(self.cumulativeCo2, self.co2, startMinute+durationMinutes)
+                - self._integral(self.cumulativeCo2, self.co2, startMinute))
+
+    def windowCost(self, startMinute, durationMinutes, co2Weight=0.0):
+        priceScale, co2Scale = self.blendScales(co2Weight)
+        cost = 0
+        if priceScale:
+            cost += priceScale*self.priceCost(startMinute, durationMinutes)
+        if co2Scale:
+            cost += co2Scale*self.co2Cost(startMinute, durationMinutes)
+        return cost
+
+    def findOptimalStart(self, durationMinutes, earliestMinute=0, latestStartMinute=None, co2Weight=0.0):
+        """Return the start minute of the cheapest window, or None if no window fits.
+
+        The window cost is piecewise linear in the start minute, bending only
+        where the start or the end crosses a slot boundary. The minimum is
+        therefore at one of those breakpoints or at the ends of the allowed
+        range, so only those candidates are evaluated. Ties go to the earliest start.
+        Searches weighing CO2 only consider windows within the slots with CO2 data.
+        """
+        latest = 60*self.numSlots - durationMinutes
+        if co2Weight > 0:
+            earliestMinute = max(earliestMinute, 60*self.co2Slots.start)
+            latest = min(latest, 60*self.co2Slots.stop - durationMinutes)
+        if latestStartMinute is not None:
+            latest = min(latest, latestStartMinute)
+        if latest < earliestMinute:
+            return None
+
+        if durationMinutes % 60 == 0:
+            # Whole-slot windows: the boundary candidates are already in the table, leaving only the ends of the range.
+            numSlots = durationMinutes // 60
+            firstStart = -(-earliestMinute // 60)
+            candidates = {earliestMinute, latest}
+            if 60*firstStart <= latest:
+                startIdx, _ = self.lookup(numSlots, latest//60 + numSlots, co2Weight, firstStart)
+                candidates.add(60*startIdx)
+            candidates = sorted(candidates)
+        else:
+            candidates = {earliestMinute, latest}
+            for boundary in range(0, 60*self.numSlots+1, 60):
+                for candidate in (boundary, boundary - durationMinutes):
+                    if earliestMinute <= candidate <= latest:
+                        candidates.add(candidate)
+            candidates = sorted(candidates)
+
+        bestStart = candidates[0]
+        bestCost = self.windowCost(bestStart, durationMinutes, co2Weight)
+        for candidate in candidates[1:]:
+            cost = self.windowCost(candidate, durationMinutes, co2Weight)
+            # Costs come from differences of running sums, so equal windows may differ by rounding. Keep the earlier one.
+            if cost < bestCost - 1e-9*abs(bestCost):
+                bestStart = candidate
+                bestCost = cost
+        return bestStart
+
+
+def getOptimalWindowTable(FuturePrices):
+    key = tuple((e.fromTs, e.price, e.co2) for e in FuturePrices)
+    if key not in optimalWindowTables:
+        optimalWindowTables[key] = OptimalWindowTable(FuturePrices)
+    return optimalWindowTables[key]
 
 
 def determineLongestConsequtiveHours(hoursToForecastInclPartial, FuturePrices):
-    startIdx = 0
-    endIdx = 0
-    min_sum = float('inf')
-    for i in range(len(FuturePrices)-(hoursToForecastInclPartial-1)):
-        window_sum = 0
-        for j in range(hoursToForecastInclPartial):
-            window_sum += FuturePrices[i+j].price
-        if window_sum < min_sum:
-            min_sum = window_sum
-            startIdx = i
-            endIdx = i+hoursToForecastInclPartial-1
-    return startIdx, endIdx
+    return getOptimalWindowTable(FuturePrices).lookup(hoursToForecastInclPartial)
 
 
 @app.get("/api/next-optimal-hour")
-async def get_most_optimal_start_and_end_for_duration(numHoursToForecast = '1h1m', glnNumber= None, max_start_time: str | None = None):
-    if glnNumber is None:
-        glnNumber = os.getenv('GLN_NUMBER')
-    if glnNumber is None or glnNumber == '':
-        raise HTTPException(status_code=500, detail="INVALID GLNNUMBER. EITHER SET IT TO VIA ENV OR PROVIDE AS PARAMETER")
+async def get_most_optimal_start_and_end_for_duration(request: Request, numHoursToForecast = '1h1m', glnNumber= None,
+                                                      max_start_time: str | None = None, objective: str = 'price', co2Weight: float = 0.5):
+    glnNumber = resolve_gln_number(glnNumber)
+    result = await run_admitted(request, glnNumber, optimisationAdmission,
+                                find_optimal_window, numHoursToForecast, glnNumber, max_start_time, objective, co2Weight)
+    with timedPhase('serialise'):
+        return JSONResponse(jsonable_encoder(result))
 
-    hoursString = numHoursToForecast.split('h')[0]
-    minuteString = numHoursToForecast.split('h')[1].split('m')[0]
-    numHoursInt = int(hoursString)
-    numMinutesInt = int(minuteString)
-    hoursToForecastInclPartial = numHoursInt
-    if numMinutesInt > 0:
-        hoursToForecastInclPartial+=1
 
-    FuturePrices = getFuturePrices(glnNumber)
-    max_start_dt = None
+async def find_optimal_window(numHoursToForecast, glnNumber, max_start_time, objective, co2Weight):
+    durationMinutes = parse_duration(numHoursToForecast)
+    co2Weight = parse_objective(objective, co2Weight)
+    # Upstream fetches block, so they run off the event loop; the search itself stays on it.
+    with timedPhase('fetch'):
+        FuturePrices = await run_in_threadpool(getFuturePrices, glnNumber)
+    searchStarted = time.perf_counter()
+    windowTable = getOptimalWindowTable(FuturePrices)
+    if co2Weight > 0 and not windowTable.hasCo2:
+        raise HTTPException(
+            status_code=400,
+            detail="CO2 emission data is not available for the requested period"
+        )
 
+    earliestMinute = windowTable.earliestStartMinute(datetime.now(UTC))
+    latestStartMinute = None
     if max_start_time is not None:
         max_start_dt = parse_max_start_time(max_start_time)
-        FuturePrices = filter_prices_by_max_start_time(
-            FuturePrices, max_start_dt, hoursToForecastInclPartial)
-
-    startIdx, endIdx = determineLongestConsequtiveHours(hoursToForecastInclPartial, FuturePrices)
-    print(startIdx)
-    print(endIdx)
-    #Were we asked to forecast a partial hour? If so, either attach this partial hour to the beginning or the end - depending on price.
-    price = 0
-    if numMinutesInt>0:
-        allHours = FuturePrices[startIdx:endIdx+1]
-        if FuturePrices[startIdx].price <= FuturePrices[endIdx].price:
-            print(f'First hour is the least expensive. Using this as a full hour and taking partial from the end {allHours[-1]}')
-            fullHours = allHours[:-1]
-            partialHour = allHours[-1]
-            startTs = min([e.fromTs for e in allHours])
-            endTs = partialHour.fromTs + timedelta(minutes=numMinutesInt)
+        if windowTable.originTs is not None:
+            latestStartMinute = math.floor(windowTable.minutesFromOrigin(max_start_dt))
+
+    startMinute = windowTable.findOptimalStart(durationMinutes, earliestMinute, latestStartMinute, co2Weight)
+    if startMinute is None:
+        if max_start_time is not None:
+            detail = "Not enough available prices before max_start_time to accommodate the requested duration"
+        elif co2Weight > 0 and len(windowTable.co2Slots) < windowTable.numSlots:
+            detail = "Not enough CO2 emission data available to accommodate the requested duration"
         else:
-            print(f'Last hour is the least expensive. Using this as a full hour and taking partial hour from the first {allHours[0]}')
-            fullHours = allHours[1:]
-            partialHour = allHours[0]
-            startTs = partialHour.toTs - timedelta(minutes=numMinutesInt)
-            endTs = max([e.toTs for e in allHours])
-
-        partialPriceSum = sum([fullHour.price for fullHour in fullHours])
-        print(f'Partial hour: {partialHour}')
-        partialPriceSum += partialHour.price*(numMinutesInt/60)
-        price = partialPriceSum / (numHoursInt + numMinutesInt/60)
-        priceIfImpatient = getTotalCostIfImpatient(FuturePrices,  numHoursInt*60+numMinutesInt)
-    else:
-        print(f"asked to present full hours only. Looking between these hours: {FuturePrices[startIdx]} and {FuturePrices[endIdx]}")
-        fullHours = FuturePrices[startIdx:endIdx+1]
-        startTs = min([e.fromTs for e in fullHours])
-        endTs =   max([e.toTs   for e in fullHours])
-        price = sum([e.price for e in fullHours]) / len(fullHours)
-        priceIfImpatient = getTotalCostIfImpatient(FuturePrices,  numHoursInt*60+numMinutesInt)
+            detail = "Not enough available prices to accommodate the requested duration"
+        raise HTTPException(status_code=400, detail=detail)
+
+    startTs = windowTable.originTs + timedelta(minutes=startMinute)
+    endTs = startTs + timedelta(minutes=durationMinutes)
+    print(f'Optimal window for {durationMinutes} minutes: {startTs} - {endTs}')
+    price = windowTable.priceCost(startMinute, durationMinutes) / (durationMinutes/60)
+    co2 = None
+    if 60*windowTable.co2Slots.start <= startMinute and startMinute + durationMinutes <= 60*windowTable.co2Slots.stop:
+        co2 = windowTable.co2Cost(startMinute, durationMinutes) / (durationMinutes/60)
+    priceIfImpatient = getTotalCostIfImpatient(FuturePrices, durationMinutes)
+    phases = requestPhases.get()
+    if phases is not None:
+        phases['search'] = time.perf_counter() - searchStarted
 
     startTs = datetime.fromtimestamp(startTs.timestamp(), tz=UTC)
     endTs =   datetime.fromtimestamp(endTs.timestamp(), tz=UTC)
 
-    if max_start_time is not None:
-        if startTs > max_start_dt:
-            raise HTTPException(
-                status_code=400,
-                detail="Calculated optimal start time exceeds max_start_time constraint"
-            )
-
-    return {'price' : {'fromTs': startTs, 'toTs': endTs, 'price': price,
-    'suboptimalPriceMultiplier': priceIfImpatient*60/(price*(numHoursInt*60+numMinutesInt))},
+    return {'price' : {'fromTs': startTs, 'toTs': endTs, 'price': price, 'co2': co2,
+    'suboptimalPriceMultiplier': priceIfImpatient*60/(price*durationMinutes)},
     'credits': '<p>Elpriser leveret af <a href="www.http://elprisen.somjson.dk/">Elprisen som json.dk</a></p>'}
 
 
 def getTotalCostIfImpatient(FuturePrices, numberOfMinutes):
-    numberOfMinutesLeftInCurrentHour = 60 - datetime.today().minute
-    totalPrice = numberOfMinutesLeftInCurrentHour * FuturePrices[0].price / 60
-    numberOfMinutes -= numberOfMinutesLeftInCurrentHour
-    i = 1
-    while numberOfMinutes > 0 and i < len(FuturePrices):
-        if numberOfMinutes > 60:
-            totalPrice += FuturePrices[i].price
-            numberOfMinutes -= 60
-            i+=1
-        else:
-            totalPrice += FuturePrices[i].price * numberOfMinutes / 60
-            numberOfMinutes = 0
-            i+=1
-    return totalPrice
+    """Cost of starting as soon as possible and running for numberOfMinutes."""
+    windowTable = getOptimalWindowTable(FuturePrices)
+    return windowTable.priceCost(windowTable.earliestStartMinute(datetime.now(UTC)), numberOfMinutes)
 
 
 def getprices(dateToFind, gln_number):
     url = f'https://elprisen.somjson.dk/elpris?GLN_Number={gln_number}&start={dateToFind.year}-{dateToFind.month:02d}-{dateToFind.day:02d}'
-    string_json = requests.get(url)
+    try:
+        string_json = requests.get(url, timeout=upstreamTimeoutSeconds)
+    except requests.RequestException as e:
+        print(f"Unable to fetch energy prices for {str(dateToFind)}. Got {e}")
+        return []
     if(string_json.status_code == 200):
         contents = json.loads(string_json.content)
         contents = contents['records']
-        possibleDates = [EnergyPrice(e['HourUTC']+'Z',e['Total']) for e in contents]
+        possibleDates = [EnergyPrice(e['HourUTC']+'Z',e['Total'],e.get('CO2Emission')) for e in contents]
         return possibleDates
     else:
         print(f"Unable to fetch energy prices for {str(dateToFind)}. Got statuscode {string_json.status_code}")
     return []
 
+def shouldProfileRequest(request):
+    requested = request.headers.get('X-Profile-Request')
+    if requested and profilingAdminToken and secrets.compare_digest(requested, profilingAdminToken):
+        return True
+    return random.random() < profilingSampleRate
+
+
+async def profile_requests(request: Request, call_next):
+    """Run selected requests under cProfile and keep their stats for the admin endpoint.
+
+    Only one request is profiled at a time, as cProfile can't be nested. cProfile
+    only sees the event loop thread: work from other requests interleaving on
+    the loop shows up in the profile, while the upstream fetch, which runs in
+    the threadpool, only shows up as time spent waiting. Phase timings (fetch,
+    upstream, search, serialise) are therefore recorded explicitly through
+    requestPhases, and kept with the profile and in the Server-Timing header.
+    """
+    global profilingActive
+    if profilingActive or not shouldProfileRequest(request):
+        return await call_next(request)
+
+    profilingActive = True
+    phases = {}
+    phasesToken = requestPhases.set(phases)
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        response = await call_next(request)
+    finally:
+        profiler.disable()
+        requestPhases.reset(phasesToken)
+        profilingActive = False
+    duration = time.perf_counter() - started
+
+    profileId = next(profileIds)
+    functionStats = {func: (nc, tt, ct) for func, (cc, nc, tt, ct, callers) in pstats.Stats(profiler).stats.items()}
+    profileSamples.append((time.time(), profileId, request.url.path, duration, phases, functionStats))
+    response.headers['X-Profile-Id'] = str(profileId)
+    response.headers['Server-Timing'] = ', '.join([f'app;dur={duration*1000:.1f}'] +
+                                                  [f'{phase};dur={seconds*1000:.1f}' for phase, seconds in phases.items()])
+    return response
+
+
+if profilingEnabled:
+    app.middleware("http")(profile_requests)
+
+
+def summariseProfiles(windowSeconds, limit, sortBy):
+    cutoff = time.time() - windowSeconds
+    samples = [sample for sample in profileSamples if sample[0] >= cutoff]
+    totals = {}
+    phaseTotals = {}
+    for _, _, _, _, phases, functionStats in samples:
+        for phase, seconds in phases.items():
+            phaseTotals[phase] = phaseTotals.get(phase, 0) + seconds
+        for func, (nc, tt, ct) in functionStats.items():
+            calls, tottime, cumtime = totals.get(func, (0, 0, 0))
+            totals[func] = (calls+nc, tottime+tt, cumtime+ct)
+    sortIdx = 2 if sortBy == 'cumtime' else 1
+    hottest = sorted(totals.items(), key=lambda item: item[1][sortIdx], reverse=True)[:limit]
+    return {'windowSeconds': windowSeconds,
+            'numProfiles': len(samples),
+            'totalDuration': sum(sample[3] for sample in samples),
+            'paths': sorted({sample[2] for sample in samples}),
+            'phases': phaseTotals,
+            'functions': [{'function': pstats.func_std_string(func), 'calls': calls, 'tottime': tottime, 'cumtime': cumtime}
+                          for func, (calls, tottime, cumtime) in hottest]}
+
+
+@app.get("/api/admin/profile")
+def get_profile_summary(windowSeconds: int | None = None, limit: int = 25, sortBy: str = 'tottime',
+                        adminToken: str | None = Header(default=None, alias='X-Admin-Token')):
+    if not profilingEnabled or not profilingAdminToken:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if adminToken is None or not secrets.compare_digest(adminToken, profilingAdminToken):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    if sortBy not in ('tottime', 'cumtime'):
+        raise HTTPException(status_code=400, detail="sortBy must be either tottime or cumtime")
+    if windowSeconds is None:
+        windowSeconds = profilingWindowSeconds
+    return summariseProfiles(windowSeconds, limit, sortBy)
+
+
+def backtestStartTs(day, startHour):
+    return backtestTimezone.localize(datetime(day.year, day.month, day.day, startHour)).astimezone(UTC)
+
+
+def backtestDays(days, durations, startHour=0):
+    """Replay the optimiser for each (day, prices) and duration.
+
+    Each run is requested at startHour local time on its day, and prices
+    should cover the day and the next, as getFuturePrices would once the next
+    day's prices are published. The optimum is searched from that moment on,
+    and the baseline is starting immediately at that moment, as
+    getTotalCostIfImpatient would.
+    """
+    rows = []
+    for day, prices in days:
+        requestTs = backtestStartTs(day, startHour)
+        windowTable = OptimalWindowTable([e for e in prices if e.toTs > requestTs])
+        earliestMinute = windowTable.earliestStartMinute(requestTs)
+        for durationMinutes in durations:
+            startMinute = windowTable.findOptimalStart(durationMinutes, earliestMinute)
+            if startMinute is None:
+                continue
+            optimalCost = windowTable.priceCost(startMinute, durationMinutes)
+            impatientCost = windowTable.priceCost(earliestMinute, durationMinutes)
+            startTs = windowTable.originTs + timedelta(minutes=startMinute)
+            rows.append({'date': day.isoformat(),
+                         'duration': format_duration(durationMinutes),
+                         'baselineStart': (windowTable.originTs + timedelta(minutes=earliestMinute)).isoformat(),
+                         'fromTs': startTs.isoformat(),
+                         'toTs': (startTs + timedelta(minutes=durationMinutes)).isoformat(),
+                         'optimalCost': optimalCost,
+                         'impatientCost': impatientCost,
+                         'savings': impatientCost - optimalCost})
+    return rows
+
+
+def runBacktest(glnNumber, fromDate, toDate, durations, startHour=0):
+    # Fetching is what takes time, so only that is spread out. Replaying a year of
+    # days takes a fraction of a second in-process, less than starting worker processes would.
+    days = [fromDate + timedelta(days=i) for i in range((toDate - fromDate).days + 2)]
+    # Probe the last day first, so a GLN number without prices costs one upstream call rather than one per day.
+    if not getCachedPrices(glnNumber, toDate):
+        raise HTTPException(status_code=400, detail=f"No prices available for this glnNumber on {toDate}")
+    prices = list(backtestFetchExecutor.map(getCachedPrices, itertools.repeat(glnNumber), days))
+    # Each day looks ahead into the next day's prices. Days without prices of their own are left out.
+    return backtestDays([(day, prices[i] + prices[i+1]) for i, day in enumerate(days[:-1]) if prices[i]],
+                        durations, startHour)
+
+
+def summariseBacktest(rows, durations):
+    summary = []
+    for durationMinutes in durations:
+        durationRows = [row for row in rows if row['duration'] == format_duration(durationMinutes)]
+        optimalCost = sum(row['optimalCost'] for row in durationRows)
+        impatientCost = sum(row['impatientCost'] for row in durationRows)
+        summary.append({'duration': format_duration(durationMinutes),
+                        'numDays': len(durationRows),
+                        'optimalCost': optimalCost,
+                        'impatientCost': impatientCost,
+                        'savings': impatientCost - optimalCost,
+                        'savingsPercent': 100*(impatientCost - optimalCost)/impatientCost if impatientCost else None})
+    return summary
+
+
+def describeBaseline(startHour):
+    return f'Starting immediately at {startHour:02d}:00 {backtestTimezone.zone} time each day'
+
+
+def parse_backtest_request(glnNumber, fromDate, toDate, durations, startHour):
+    glnNumber = resolve_gln_number(glnNumber)
+    try:
+        fromDay = date.fromisoformat(fromDate)
+        toDay = date.fromisoformat(toDate)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid date format. Expected YYYY-MM-DD: {str(e)}"
+        ) from e
+    if toDay < fromDay:
+        raise HTTPException(status_code=400, detail="toDate must not be before fromDate")
+    if toDay > date.today():
+        raise HTTPException(status_code=400, detail="toDate must not be in the future")
+    if (toDay - fromDay).days + 1 > backtestMaxDays:
+        raise HTTPException(status_code=400, detail=f"Backtests are limited to {backtestMaxDays} days")
+    if not 0 <= startHour <= 23:
+        raise HTTPException(status_code=400, detail="startHour must be between 0 and 23")
+    durationMinutes = list(dict.fromkeys(parse_duration(d.strip()) for d in durations.split(',')))
+    return glnNumber, fromDay, toDay, durationMinutes
+
+
+@app.get("/api/backtest")
+async def get_backtest_summary(request: Request, fromDate: str, toDate: str, durations: str = '1h0m,2h0m,3h0m', glnNumber = None,
+                               startHour: int = 0):
+    glnNumber, fromDay, toDay, durationMinutes = parse_backtest_request(glnNumber, fromDate, toDate, durations, startHour)
+    rows = await run_admitted(request, glnNumber, backtestAdmission,
+                              run_in_threadpool, runBacktest, glnNumber, fromDay, toDay, durationMinutes, startHour)
+    return {'fromDate': fromDay, 'toDate': toDay, 'startHour': startHour, 'baseline': describeBaseline(startHour),
+    'summary': summariseBacktest(rows, durationMinutes),
+    'credits': '<p>Elpriser leveret af <a href="www.http://elprisen.somjson.dk/">Elprisen som json.dk</a></p>'}
+
+
+@app.get("/api/backtest.csv")
+async def get_backtest_csv(request: Request, fromDate: str, toDate: str, durations: str = '1h0m,2h0m,3h0m', glnNumber = None,
+                           startHour: int = 0):
+    glnNumber, fromDay, toDay, durationMinutes = parse_backtest_request(glnNumber, fromDate, toDate, durations, startHour)
+    rows = await run_admitted(request, glnNumber, backtestAdmission,
+                              run_in_threadpool, runBacktest, glnNumber, fromDay, toDay, durationMinutes, startHour)
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=['date', 'duration', 'baselineStart', 'fromTs', 'toTs',
+                                                'optimalCost', 'impatientCost', 'savings'])
+    writer.writeheader()
+    writer.writerows(rows)
+    return Response(content=output.getvalue(), media_type='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="backtest_{fromDay}_{toDay}.csv"'})
+
+
 @app.get("/healthz", status_code=204)
 def healthcheck():
     return None
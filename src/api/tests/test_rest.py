@@ -1,9 +1,13 @@
+import asyncio
 import json
 import os
+import threading
+import time
 from datetime import UTC, date, datetime, timedelta
 from unittest.mock import MagicMock, patch
 
 import pytest
+import requests
 
 try:
     from fastapi.testclient import TestClient
@@ -20,16 +24,29 @@ except ImportError:
     FREEZEGUN_AVAILABLE = False
 
 from rest import (
+    AdmissionController,
     EnergyPrice,
+    OptimalWindowTable,
+    TokenBucket,
     cachedPrices,
+    chargedGlns,
+    clientBuckets,
     determineLongestConsequtiveHours,
+    getCachedPrices,
     getFuturePrices,
+    getOptimalWindowTable,
     getprices,
     getTotalCostIfImpatient,
+    glnBuckets,
+    profileSamples,
+    runBacktest,
+    uncachedGlnBucket,
 )
 
 if FASTAPI_AVAILABLE:
-    from rest import app
+    from fastapi import FastAPI, HTTPException
+
+    from rest import app, get_most_optimal_start_and_end_for_duration, profile_requests
 
 
 @pytest.fixture
@@ -119,6 +136,17 @@ def sample_energy_prices():
     ]
 
 
+@pytest.fixture
+def sample_energy_prices_with_co2():
+    """Sample EnergyPrice objects with CO2 emissions, where the cheapest and cleanest hours differ."""
+    return [
+        EnergyPrice("2024-01-15T12:00:00Z", 0.5, 75.5),
+        EnergyPrice("2024-01-15T13:00:00Z", 0.3, 136.5),
+        EnergyPrice("2024-01-15T14:00:00Z", 0.7, 160.17),
+        EnergyPrice("2024-01-15T15:00:00Z", 0.4, 40.0),
+    ]
+
+
 class TestEnergyPrice:
     """Test EnergyPrice class functionality."""
 
@@ -168,10 +196,12 @@ class TestGetPrices:
         assert all(isinstance(price, EnergyPrice) for price in result)
         assert result[0].price == 0.5
         assert result[1].price == 0.3
+        assert result[0].co2 == 75.5
+        assert result[1].co2 == 136.5
 
         # Verify API call was made correctly
         expected_url = f'https://elprisen.somjson.dk/elpris?GLN_Number={gln_number}&start=2024-01-15'
-        mock_get.assert_called_once_with(expected_url)
+        mock_get.assert_called_once_with(expected_url, timeout=10)
 
     @patch('rest.requests.get')
     def test_api_response_with_grid_company_info(self, mock_get, sample_energy_data):
@@ -223,6 +253,15 @@ class TestGetPrices:
 
         assert result == []
 
+    @patch('rest.requests.get')
+    def test_upstream_timeout(self, mock_get):
+        """Test that an upstream timeout is treated like a failed response."""
+        mock_get.side_effect = requests.Timeout("timed out")
+
+        result = getprices(date(2024, 1, 15), "123456789")
+
+        assert result == []
+
 
 class TestGetFuturePrices:
     """Test getFuturePrices function."""
@@ -231,6 +270,8 @@ class TestGetFuturePrices:
         """Clear cache before each test."""
         global cachedPrices
         cachedPrices.clear()
+        chargedGlns.clear()
+        uncachedGlnBucket.tokens = uncachedGlnBucket.capacity
 
     @patch('rest.getprices')
     def test_caching_mechanism(self, mock_getprices, sample_energy_prices):
@@ -279,6 +320,77 @@ class TestGetFuturePrices:
         # Should only include current and future prices
         assert len(result) >= 2  # At least current and future
 
+    @patch('rest.getprices')
+    def test_caps_uncached_gln_fetches(self, mock_getprices, sample_energy_prices):
+        """Test that fetching prices for new GLN numbers is capped, while cached ones are still served."""
+        mock_getprices.return_value = sample_energy_prices
+
+        with patch('rest.uncachedGlnBucket', TokenBucket(0.01, 1)):
+            getFuturePrices("111111111")
+
+            with pytest.raises(HTTPException) as exc_info:
+                getFuturePrices("222222222")
+            assert exc_info.value.status_code == 503
+            assert int(exc_info.value.headers['Retry-After']) > 0
+
+            getFuturePrices("111111111")
+        assert mock_getprices.call_count == 2
+
+    @patch('rest.getprices')
+    def test_known_gln_not_capped_after_charge_expires(self, mock_getprices, sample_energy_prices):
+        """Test that a GLN which returned prices is not blocked by a flood of new GLN numbers at day rollover."""
+        mock_getprices.side_effect = lambda day, gln_number: sample_energy_prices if gln_number == "legit" else []
+
+        with patch('rest.uncachedGlnBucket', TokenBucket(0.0001, 21)):
+            getCachedPrices("legit", date(2024, 1, 15))
+            for i in range(20):
+                getCachedPrices(f"random{i}", date(2024, 1, 15))
+            # A day later the next day's prices are fetched for the GLN that had prices without taking a token
+            chargedGlns.expire(time.monotonic() + 86401)
+
+            assert getCachedPrices("legit", date(2024, 1, 16)) == sample_energy_prices
+
+            # while new GLN numbers are still capped
+            with pytest.raises(HTTPException) as exc_info:
+                getCachedPrices("random20", date(2024, 1, 16))
+            assert exc_info.value.status_code == 503
+
+    @patch('rest.getprices')
+    def test_concurrent_fetches_for_new_gln_fetch_once(self, mock_getprices, sample_energy_prices):
+        """Test that concurrent requests for one new GLN share a single fetch per day and a single token."""
+        def slow_getprices(day, gln_number):
+            time.sleep(0.05)
+            return sample_energy_prices
+        mock_getprices.side_effect = slow_getprices
+        bucket = TokenBucket(0.0001, 10)
+
+        with patch('rest.uncachedGlnBucket', bucket):
+            threads = [threading.Thread(target=getFuturePrices, args=("999",)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert mock_getprices.call_count == 2
+        assert bucket.tokens == pytest.approx(9, abs=0.01)
+
+    @patch('rest.getprices')
+    def test_empty_prices_are_retried_after_an_interval(self, mock_getprices, sample_energy_prices):
+        """Test that empty results (e.g. an invalid GLN) are not refetched on every call, but do expire."""
+        mock_getprices.return_value = []
+
+        getFuturePrices("000000000")
+        getFuturePrices("000000000")
+        assert mock_getprices.call_count == 2
+
+        mock_getprices.return_value = sample_energy_prices
+        getFuturePrices("123456789")
+        cachedPrices.expire(time.monotonic() + 901)
+
+        today_str = date.today().strftime('%m/%d/%Y')
+        assert f"000000000_{today_str}" not in cachedPrices
+        assert f"123456789_{today_str}" in cachedPrices
+
 
 class TestDetermineLongestConsequtiveHours:
     """Test determineLongestConsequtiveHours function."""
@@ -313,6 +425,192 @@ class TestDetermineLongestConsequtiveHours:
         assert end_idx == 0
 
 
+class TestOptimalWindowTable:
+    """Test OptimalWindowTable precomputation and lookups."""
+
+    def test_lookup_matches_brute_force_for_every_duration(self):
+        """Test that every duration matches an exhaustive window search."""
+        prices = [0.9, 0.2, 0.4, 0.4, 1.3, 0.1, 0.1, 0.8]
+        energy_prices = [EnergyPrice(f"2024-01-15T{h:02d}:00:00Z", p) for h, p in enumerate(prices)]
+
+        table = OptimalWindowTable(energy_prices)
+
+        for num_slots in range(1, len(prices) + 1):
+            sums = [sum(prices[i:i + num_slots]) for i in range(len(prices) - num_slots + 1)]
+            expected_start = sums.index(min(sums))
+            assert table.lookup(num_slots) == (expected_start, expected_start + num_slots - 1)
+            assert abs(table.averagePrice(num_slots, expected_start) - min(sums) / num_slots) < 1e-9
+
+    def test_lookup_restricted_to_available_slots(self, sample_energy_prices):
+        """Test that the prefix-minimum index only considers windows within the available slots."""
+        table = OptimalWindowTable(sample_energy_prices)
+
+        # Prices: [0.5, 0.3, 0.7, 0.4]; 1-hour windows within the first slot only
+        assert table.lookup(1, 1) == (0, 0)
+        # 2-hour windows within the first three slots: [0.5, 0.3] is still the cheapest
+        assert table.lookup(2, 3) == (0, 1)
+        # Not enough slots for the duration
+        assert table.lookup(3, 2) == (0, 0)
+
+    def test_lookup_by_objective(self, sample_energy_prices_with_co2):
+        """Test that price, CO2 and blended objectives select their own windows."""
+        table = OptimalWindowTable(sample_energy_prices_with_co2)
+
+        assert table.hasCo2
+        # Prices: [0.5, 0.3, 0.7, 0.4], CO2: [75.5, 136.5, 160.17, 40.0]
+        assert table.lookup(1, co2Weight=0.0) == (1, 1)
+        assert table.lookup(1, co2Weight=1.0) == (3, 3)
+        assert table.lookup(2, co2Weight=1.0) == (2, 3)
+        # Blending normalises each objective by its mean, so the last hour wins a 50/50 blend
+        assert table.lookup(1, co2Weight=0.5) == (3, 3)
+        assert abs(table.averageCo2(2, 0) - (75.5 + 136.5) / 2) < 1e-9
+
+    def test_missing_co2_data(self, sample_energy_prices):
+        """Test that a series without CO2 data is flagged."""
+        table = OptimalWindowTable(sample_energy_prices)
+
+        assert not table.hasCo2
+
+    def test_partial_co2_data(self, sample_energy_prices_with_co2):
+        """Test that CO2 searches are limited to the slots with CO2 data."""
+        prices = [EnergyPrice("2024-01-15T11:00:00Z", 0.2)] + sample_energy_prices_with_co2[:3] + [
+            EnergyPrice("2024-01-15T15:00:00Z", 0.1),
+        ]
+        table = OptimalWindowTable(prices)
+
+        # CO2: [None, 75.5, 136.5, 160.17, None]
+        assert table.hasCo2
+        assert table.co2Slots == range(1, 4)
+        assert table.findOptimalStart(60, co2Weight=1.0) == 60
+        assert table.findOptimalStart(180, co2Weight=0.5) == 60
+        assert table.findOptimalStart(240, co2Weight=1.0) is None
+        # Price searches still use every slot
+        assert table.findOptimalStart(60) == 240
+
+    def test_find_optimal_start_at_minute_resolution(self, sample_energy_prices):
+        """Test that a partial-hour duration may start between slot boundaries."""
+        table = OptimalWindowTable(sample_energy_prices)
+
+        # Prices: [0.5, 0.3, 0.7, 0.4]; 90 minutes from 12:30 costs 30*0.5 + 60*0.3 minutes
+        assert table.findOptimalStart(90) == 30
+        assert abs(table.priceCost(30, 90) - (0.5 * 0.5 + 0.3)) < 1e-9
+        # 30 minutes fits entirely in the cheapest hour, which starts at 13:00
+        assert table.findOptimalStart(30) == 60
+
+    def test_find_optimal_start_respects_bounds(self, sample_energy_prices):
+        """Test the earliest start and max start constraints."""
+        table = OptimalWindowTable(sample_energy_prices)
+
+        # Cannot start before minute 70, so the run is pushed to the end of the cheapest hour
+        assert table.findOptimalStart(60, earliestMinute=70) == 70
+        # Starting no later than 12:20 the cheapest hour can only be partly used
+        assert table.findOptimalStart(60, latestStartMinute=20) == 20
+        # The duration does not fit before the end of the series
+        assert table.findOptimalStart(300) is None
+        assert table.findOptimalStart(60, latestStartMinute=-1) is None
+
+    def test_lookup_from_second_slot(self, sample_energy_prices_with_co2):
+        """Test that lookups can skip the first slot, as when now is inside it."""
+        table = OptimalWindowTable(sample_energy_prices_with_co2)
+
+        # Prices: [0.5, 0.3, 0.7, 0.4]; from slot 1, [0.3, 0.7] and [0.7, 0.4] are the candidates
+        assert table.lookup(2, firstStart=1) == (1, 2)
+        # CO2: [75.5, 136.5, 160.17, 40.0]
+        assert table.lookup(1, firstStart=1, co2Weight=1.0) == (3, 3)
+        assert table.lookup(1, 2, firstStart=1) == (1, 1)
+        # Starting from slot 2 falls back to scanning the window sums
+        assert table.lookup(1, firstStart=2) == (3, 3)
+        assert table.lookup(4, firstStart=1) == (0, 0)
+
+    def test_whole_hours_mid_slot_use_table(self, sample_energy_prices):
+        """Test that whole-hour durations starting inside the current slot only evaluate a few candidates."""
+        table = OptimalWindowTable(sample_energy_prices)
+
+        with patch.object(table, 'windowCost', wraps=table.windowCost) as window_cost:
+            # Starting at 12:20 the options are 12:20, any later hour, or the latest start
+            assert table.findOptimalStart(60, earliestMinute=20) == 60
+
+        assert window_cost.call_count <= 3
+
+    def test_find_optimal_start_matches_every_minute(self):
+        """Test that checking breakpoints gives the same cost as trying every minute."""
+        prices = [0.9, 0.2, 0.4, 0.4, 1.3, 0.1, 0.15, 0.8]
+        energy_prices = [EnergyPrice(f"2024-01-15T{h:02d}:00:00Z", p) for h, p in enumerate(prices)]
+        per_minute = [p for p in prices for _ in range(60)]
+        table = OptimalWindowTable(energy_prices)
+
+        for duration in (17, 60, 95, 150, 240):
+            for earliest in (0, 25):
+                best = min(sum(per_minute[s:s + duration]) / 60 for s in range(earliest, len(per_minute) - duration + 1))
+                start = table.findOptimalStart(duration, earliestMinute=earliest)
+                assert start >= earliest
+                assert abs(table.priceCost(start, duration) - best) < 1e-9
+
+    def test_table_is_cached_per_price_series(self, sample_energy_prices):
+        """Test that the table is built once per price series and rebuilt when prices change."""
+        first = getOptimalWindowTable(sample_energy_prices)
+        assert getOptimalWindowTable(list(sample_energy_prices)) is first
+
+        changed = sample_energy_prices[:-1] + [EnergyPrice("2024-01-15T15:00:00Z", 0.1)]
+        assert getOptimalWindowTable(changed) is not first
+
+
+class TestAdmissionControl:
+    """Test the token bucket and admission controller."""
+
+    @patch('rest.time.monotonic')
+    def test_token_bucket_refills_over_time(self, mock_monotonic):
+        """Test that a bucket allows a burst and then refills at its rate."""
+        mock_monotonic.return_value = 100.0
+        bucket = TokenBucket(2, 2)
+
+        assert bucket.take() == 0
+        assert bucket.take() == 0
+        assert bucket.take() == pytest.approx(0.5)
+
+        mock_monotonic.return_value = 100.5
+        assert bucket.take() == 0
+        assert bucket.take() > 0
+
+    def test_admission_queues_then_sheds(self):
+        """Test that requests beyond the in-flight limit queue, and are rejected once the queue is full."""
+        async def scenario():
+            admission = AdmissionController(1, 1)
+            assert await admission.acquire()
+
+            queued = asyncio.create_task(admission.acquire())
+            await asyncio.sleep(0)
+            assert not queued.done()
+            assert not await admission.acquire()
+
+            admission.release()
+            assert await queued
+            assert admission.inFlight == 1
+
+            admission.release()
+            assert admission.inFlight == 0
+
+        asyncio.run(scenario())
+
+    def test_admission_cancelled_waiter_leaves_queue(self):
+        """Test that a cancelled waiter frees its queue position."""
+        async def scenario():
+            admission = AdmissionController(1, 1)
+            await admission.acquire()
+
+            queued = asyncio.create_task(admission.acquire())
+            await asyncio.sleep(0)
+            queued.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await queued
+            assert len(admission.waiters) == 0
+
+            admission.release()
+            assert admission.inFlight == 0
+
+        asyncio.run(scenario())
+
+
 class TestGetTotalCostIfImpatient:
     """Test getTotalCostIfImpatient function."""
 
@@ -336,14 +634,32 @@ class TestGetTotalCostIfImpatient:
         expected = (15 * sample_energy_prices[0].price / 60) + sample_energy_prices[1].price
         assert abs(result - expected) < 0.001
 
+    @freeze_time("2024-01-15T12:30:00Z")
+    def test_duration_shorter_than_rest_of_hour(self, sample_energy_prices):
+        """Test that only the requested minutes are charged."""
+        result = getTotalCostIfImpatient(sample_energy_prices, 10)
+
+        expected = 10 * sample_energy_prices[0].price / 60
+        assert abs(result - expected) < 0.001
+
+    @freeze_time("2024-01-15T12:30:00Z")
+    def test_duration_beyond_available_prices(self, sample_energy_prices):
+        """Test that the cost is truncated at the end of the known prices."""
+        result = getTotalCostIfImpatient(sample_energy_prices, 600)
+
+        expected = 0.5 * 0.5 + 0.3 + 0.7 + 0.4
+        assert abs(result - expected) < 0.001
+
 
 class TestAPIEndpoints:
     """Test FastAPI endpoints."""
 
     def setup_method(self):
-        """Clear cache and reset environment before each test."""
+        """Clear cache, rate limits and reset environment before each test."""
         global cachedPrices
         cachedPrices.clear()
+        clientBuckets.clear()
+        glnBuckets.clear()
         # Clear GLN_NUMBER from environment
         if 'GLN_NUMBER' in os.environ:
             del os.environ['GLN_NUMBER']
@@ -503,6 +819,183 @@ class TestAPIEndpoints:
         duration = to_ts - from_ts
         assert duration.total_seconds() == 10800  # 3 hours in seconds
 
+    @patch('rest.getFuturePrices')
+    @patch('rest.getTotalCostIfImpatient')
+    def test_next_optimal_hour_co2_objective(self, mock_impatient, mock_future, client, sample_energy_prices_with_co2):
+        """Test /api/next-optimal-hour optimising for CO2 instead of price."""
+        mock_future.return_value = sample_energy_prices_with_co2
+        mock_impatient.return_value = 1.5
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003&objective=co2")
+
+        assert response.status_code == 200
+        price_data = response.json()['price']
+        assert datetime.fromisoformat(price_data['fromTs']) == datetime.fromisoformat("2024-01-15T15:00:00Z")
+        assert abs(price_data['price'] - 0.4) < 0.01
+        assert abs(price_data['co2'] - 40.0) < 0.01
+
+    @patch('rest.getFuturePrices')
+    @patch('rest.getTotalCostIfImpatient')
+    def test_next_optimal_hour_blend_objective(self, mock_impatient, mock_future, client, sample_energy_prices_with_co2):
+        """Test /api/next-optimal-hour with a weighted blend of price and CO2."""
+        mock_future.return_value = sample_energy_prices_with_co2
+        mock_impatient.return_value = 1.5
+
+        response = client.get(
+            "/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003&objective=blend&co2Weight=0.1"
+        )
+
+        assert response.status_code == 200
+        price_data = response.json()['price']
+        # With little weight on CO2 the cheapest hour still wins
+        assert datetime.fromisoformat(price_data['fromTs']) == datetime.fromisoformat("2024-01-15T13:00:00Z")
+
+    @patch('rest.getFuturePrices')
+    def test_next_optimal_hour_invalid_objective(self, mock_future, client, sample_energy_prices_with_co2):
+        """Test that unknown objectives and out-of-range weights are rejected."""
+        mock_future.return_value = sample_energy_prices_with_co2
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003&objective=cheapest")
+        assert response.status_code == 400
+        assert "Invalid objective" in response.json()["detail"]
+
+        response = client.get(
+            "/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003&objective=blend&co2Weight=1.5"
+        )
+        assert response.status_code == 400
+        assert "co2Weight" in response.json()["detail"]
+
+    @patch('rest.getFuturePrices')
+    def test_next_optimal_hour_co2_objective_without_co2_data(self, mock_future, client, sample_energy_prices):
+        """Test that a CO2 objective is rejected when the series has no CO2 data."""
+        mock_future.return_value = sample_energy_prices
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003&objective=co2")
+
+        assert response.status_code == 400
+        assert "CO2 emission data is not available" in response.json()["detail"]
+
+    @patch('rest.getFuturePrices')
+    @patch('rest.getTotalCostIfImpatient')
+    def test_next_optimal_hour_partial_co2_data(self, mock_impatient, mock_future, client, sample_energy_prices_with_co2):
+        """Test that CO2 objectives use the slots with CO2 data when only some records have it."""
+        mock_future.return_value = sample_energy_prices_with_co2[:2] + [
+            EnergyPrice("2024-01-15T14:00:00Z", 0.7),
+            EnergyPrice("2024-01-15T15:00:00Z", 0.1),
+        ]
+        mock_impatient.return_value = 1.5
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003&objective=co2")
+        assert response.status_code == 200
+        price_data = response.json()['price']
+        assert datetime.fromisoformat(price_data['fromTs']) == datetime.fromisoformat("2024-01-15T12:00:00Z")
+        assert abs(price_data['co2'] - 75.5) < 0.01
+
+        # A price search may pick a slot without CO2 data, which is then not reported
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003")
+        assert response.status_code == 200
+        price_data = response.json()['price']
+        assert datetime.fromisoformat(price_data['fromTs']) == datetime.fromisoformat("2024-01-15T15:00:00Z")
+        assert price_data['co2'] is None
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=3h0m&glnNumber=5790000611003&objective=co2")
+        assert response.status_code == 400
+        assert "Not enough CO2 emission data" in response.json()["detail"]
+
+    @freeze_time("2024-01-15T12:20:00Z")
+    @patch('rest.getFuturePrices')
+    def test_next_optimal_hour_never_starts_in_the_past(self, mock_future, client, sample_energy_prices):
+        """Test that a window starting in the current slot starts no earlier than now."""
+        mock_future.return_value = [
+            EnergyPrice("2024-01-15T12:00:00Z", 0.1),
+            EnergyPrice("2024-01-15T13:00:00Z", 0.9),
+            EnergyPrice("2024-01-15T14:00:00Z", 0.9),
+        ]
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=0h30m&glnNumber=5790000611003")
+
+        assert response.status_code == 200
+        price_data = response.json()['price']
+        assert datetime.fromisoformat(price_data['fromTs']) == datetime.fromisoformat("2024-01-15T12:20:00Z")
+        assert datetime.fromisoformat(price_data['toTs']) == datetime.fromisoformat("2024-01-15T12:50:00Z")
+        assert abs(price_data['price'] - 0.1) < 0.001
+        # Starting right away is the optimum, so there is nothing to gain by waiting
+        assert abs(price_data['suboptimalPriceMultiplier'] - 1.0) < 0.001
+
+    @patch('rest.getFuturePrices')
+    def test_next_optimal_hour_zero_duration(self, mock_future, client, sample_energy_prices):
+        """Test that a zero duration is rejected."""
+        mock_future.return_value = sample_energy_prices
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=0h0m&glnNumber=5790000611003")
+
+        assert response.status_code == 400
+        assert "positive duration" in response.json()["detail"]
+
+    @patch('rest.getFuturePrices')
+    @patch('rest.clientBurst', 2)
+    @patch('rest.clientRatePerSecond', 0.01)
+    def test_next_optimal_hour_client_rate_limit(self, mock_future, client, sample_energy_prices):
+        """Test that a client exceeding its token bucket gets 429 with Retry-After."""
+        mock_future.return_value = sample_energy_prices
+
+        for gln in ("5790000611003", "5790000611004"):
+            response = client.get(f"/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber={gln}")
+            assert response.status_code == 200
+
+        response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611005")
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+
+    @patch('rest.getFuturePrices')
+    @patch('rest.glnBurst', 1)
+    @patch('rest.glnRatePerSecond', 0.01)
+    def test_next_optimal_hour_gln_rate_limit(self, mock_future, client, sample_energy_prices):
+        """Test that each GLN number has its own token bucket."""
+        mock_future.return_value = sample_energy_prices
+
+        assert client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003").status_code == 200
+        assert client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003").status_code == 429
+        assert client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611004").status_code == 200
+
+    @patch('rest.getFuturePrices')
+    def test_next_optimal_hour_sheds_load_when_queue_is_full(self, mock_future, client, sample_energy_prices):
+        """Test that requests are rejected with 503 when no slot or queue position is available."""
+        mock_future.return_value = sample_energy_prices
+
+        with patch('rest.optimisationAdmission', AdmissionController(0, 0)):
+            response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003")
+
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == "1"
+
+    @patch('rest.getFuturePrices')
+    def test_next_optimal_hour_releases_slot_on_error(self, mock_future, client, sample_energy_prices):
+        """Test that the in-flight slot is released when the request fails."""
+        mock_future.return_value = sample_energy_prices
+        admission = AdmissionController(1, 0)
+
+        with patch('rest.optimisationAdmission', admission):
+            response = client.get("/api/next-optimal-hour?numHoursToForecast=0h0m&glnNumber=5790000611003")
+            assert response.status_code == 400
+            response = client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003")
+            assert response.status_code == 200
+
+        assert admission.inFlight == 0
+
+    @patch('rest.getFuturePrices')
+    @patch('rest.clientBurst', 1)
+    @patch('rest.clientRatePerSecond', 0.01)
+    @patch('rest.clientIpHeader', 'X-Forwarded-For')
+    def test_next_optimal_hour_client_from_forwarded_header(self, mock_future, client, sample_energy_prices):
+        """Test that clients behind a proxy are told apart by the configured header's last entry."""
+        mock_future.return_value = sample_energy_prices
+        url = "/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003"
+
+        assert client.get(url, headers={'X-Forwarded-For': "10.0.0.1"}).status_code == 200
+        assert client.get(url, headers={'X-Forwarded-For': "10.0.0.1, 10.0.0.2"}).status_code == 200
+        assert client.get(url, headers={'X-Forwarded-For': "10.0.0.2"}).status_code == 429
+
     def test_healthz_endpoint(self, client):
         """Test /healthz endpoint."""
         response = client.get("/healthz")
@@ -592,3 +1085,320 @@ class TestAPIEndpoints:
         max_start_dt = datetime.fromisoformat(max_start)
 
         assert from_ts <= max_start_dt
+
+
+class TestProfiling:
+    """Test the on-demand profiling middleware and admin endpoint."""
+
+    def setup_method(self):
+        """Clear collected profiles before each test."""
+        profileSamples.clear()
+
+    @pytest.fixture
+    def profiled_client(self):
+        """Client for a small app with the profiling middleware installed."""
+        profiled_app = FastAPI()
+        profiled_app.middleware("http")(profile_requests)
+
+        @profiled_app.get("/work")
+        async def work():
+            return {'total': sum(range(1000))}
+
+        profiled_app.get("/api/next-optimal-hour")(get_most_optimal_start_and_end_for_duration)
+
+        return TestClient(profiled_app)
+
+    @patch('rest.profilingAdminToken', 'secret')
+    @patch('rest.profilingSampleRate', 0.0)
+    def test_profiles_only_selected_requests(self, profiled_client):
+        """Test that requests are profiled only when selected by header."""
+        response = profiled_client.get("/work")
+        assert response.status_code == 200
+        assert 'X-Profile-Id' not in response.headers
+        assert len(profileSamples) == 0
+
+        response = profiled_client.get("/work", headers={'X-Profile-Request': 'wrong'})
+        assert 'X-Profile-Id' not in response.headers
+
+        response = profiled_client.get("/work", headers={'X-Profile-Request': 'secret'})
+        assert response.status_code == 200
+        assert response.json() == {'total': 499500}
+        assert 'X-Profile-Id' in response.headers
+        assert 'Server-Timing' in response.headers
+        assert len(profileSamples) == 1
+        assert profileSamples[0][2] == "/work"
+
+    @patch('rest.profilingAdminToken', '')
+    @patch('rest.profilingSampleRate', 1.0)
+    def test_profiles_sampled_requests(self, profiled_client):
+        """Test that a sample rate of 1 profiles every request."""
+        profiled_client.get("/work")
+        profiled_client.get("/work")
+
+        assert len(profileSamples) == 2
+
+    @patch('rest.profilingAdminToken', 'secret')
+    @patch('rest.profilingSampleRate', 0.0)
+    def test_profiles_threadpool_phases(self, profiled_client):
+        """Test that the upstream fetch run in the threadpool is timed, though cProfile can't see it."""
+        cachedPrices.clear()
+        chargedGlns.clear()
+        clientBuckets.clear()
+        glnBuckets.clear()
+
+        def slow_prices(day, gln_number):
+            time.sleep(0.05)
+            return [EnergyPrice(f"{day.isoformat()}T{h:02d}:00:00Z", 0.5) for h in range(24)]
+
+        with patch('rest.getprices', side_effect=slow_prices):
+            response = profiled_client.get("/api/next-optimal-hour?numHoursToForecast=1h0m&glnNumber=5790000611003",
+                                           headers={'X-Profile-Request': 'secret'})
+
+        assert response.status_code == 200
+        timings = dict(entry.split(';dur=') for entry in response.headers['Server-Timing'].split(', '))
+        assert set(timings) == {'app', 'fetch', 'upstream', 'search', 'serialise'}
+        # Today and tomorrow are each fetched once
+        assert float(timings['upstream']) >= 100
+        assert float(timings['fetch']) >= float(timings['upstream'])
+        phases = profileSamples[0][4]
+        assert phases['upstream'] >= 0.1
+        assert phases['fetch'] <= profileSamples[0][3]
+
+    @patch('rest.profilingEnabled', True)
+    @patch('rest.profilingAdminToken', 'secret')
+    @patch('rest.profilingSampleRate', 0.0)
+    def test_admin_endpoint_sums_phases(self, client, profiled_client):
+        """Test that the admin endpoint totals the phase timings of recent profiles."""
+        cachedPrices.clear()
+        chargedGlns.clear()
+        clientBuckets.clear()
+        glnBuckets.clear()
+        future_day = date.today() + timedelta(days=1)
+        prices = [EnergyPrice(f"{future_day.isoformat()}T{h:02d}:00:00Z", 0.5) for h in range(24)]
+
+        with patch('rest.getprices', return_value=prices):
+            profiled_client.get("/api/next-optimal-hour?glnNumber=5790000611003", headers={'X-Profile-Request': 'secret'})
+        profiled_client.get("/work", headers={'X-Profile-Request': 'secret'})
+
+        response = client.get("/api/admin/profile", headers={'X-Admin-Token': 'secret'})
+
+        assert response.status_code == 200
+        assert set(response.json()['phases']) == {'fetch', 'upstream', 'search', 'serialise'}
+
+    @patch('rest.profilingEnabled', False)
+    def test_admin_endpoint_disabled(self, client):
+        """Test that the admin endpoint is hidden when profiling is disabled."""
+        response = client.get("/api/admin/profile", headers={'X-Admin-Token': 'secret'})
+
+        assert response.status_code == 404
+
+    @patch('rest.profilingEnabled', True)
+    @patch('rest.profilingAdminToken', 'secret')
+    def test_admin_endpoint_requires_token(self, client):
+        """Test that the admin endpoint rejects missing or wrong tokens."""
+        assert client.get("/api/admin/profile").status_code == 403
+        assert client.get("/api/admin/profile", headers={'X-Admin-Token': 'wrong'}).status_code == 403
+
+    @patch('rest.profilingEnabled', True)
+    @patch('rest.profilingAdminToken', 'secret')
+    @patch('rest.profilingSampleRate', 0.0)
+    def test_admin_endpoint_aggregates_recent_profiles(self, client, profiled_client):
+        """Test that the admin endpoint aggregates hot functions over recent profiles."""
+        profiled_client.get("/work", headers={'X-Profile-Request': 'secret'})
+        profiled_client.get("/work", headers={'X-Profile-Request': 'secret'})
+
+        response = client.get("/api/admin/profile?limit=5&sortBy=cumtime", headers={'X-Admin-Token': 'secret'})
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data['numProfiles'] == 2
+        assert data['paths'] == ["/work"]
+        assert 0 < len(data['functions']) <= 5
+        cumtimes = [f['cumtime'] for f in data['functions']]
+        assert cumtimes == sorted(cumtimes, reverse=True)
+
+        # Profiles older than the window are left out
+        response = client.get("/api/admin/profile?windowSeconds=0", headers={'X-Admin-Token': 'secret'})
+        assert response.json()['numProfiles'] == 0
+
+
+def historical_prices(day, gln_number):
+    """Fake upstream prices for a past day: expensive mornings, cheap afternoons."""
+    return [
+        EnergyPrice(f"{day.isoformat()}T{h:02d}:00:00Z", 1.0 if h < 12 else 0.2)
+        for h in range(24)
+    ]
+
+
+class TestBacktest:
+    """Test the historical backtest engine and endpoints."""
+
+    def setup_method(self):
+        """Clear cache and rate limits before each test."""
+        cachedPrices.clear()
+        chargedGlns.clear()
+        uncachedGlnBucket.tokens = uncachedGlnBucket.capacity
+        clientBuckets.clear()
+        glnBuckets.clear()
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    def test_run_backtest_rows(self, mock_getprices):
+        """Test that each day and duration is replayed against starting immediately at local midnight."""
+        rows = runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 3), [60, 90])
+
+        # The day after the range is fetched too, to look ahead into
+        assert mock_getprices.call_count == 4
+        assert len(rows) == 6
+        first = rows[0]
+        assert first['date'] == "2024-01-01"
+        assert first['duration'] == "1h0m"
+        # Local midnight is 23:00 UTC, before the first fake slot
+        assert datetime.fromisoformat(first['baselineStart']) == datetime.fromisoformat("2024-01-01T00:00:00Z")
+        assert datetime.fromisoformat(first['fromTs']) == datetime.fromisoformat("2024-01-01T12:00:00Z")
+        assert abs(first['impatientCost'] - 1.0) < 1e-9
+        assert abs(first['optimalCost'] - 0.2) < 1e-9
+        assert abs(first['savings'] - 0.8) < 1e-9
+        assert abs(rows[1]['savings'] - (1.5 - 0.3)) < 1e-9
+
+        # Historical prices are cached
+        runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 3), [60])
+        assert mock_getprices.call_count == 4
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    def test_run_backtest_keeps_day_order(self, mock_getprices):
+        """Test that days fetched concurrently are replayed in date order."""
+        rows = runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 20), [60])
+
+        assert mock_getprices.call_count == 21
+        assert [row['date'] for row in rows] == [(date(2024, 1, 1) + timedelta(days=d)).isoformat() for d in range(20)]
+        assert all(abs(row['savings'] - 0.8) < 1e-9 for row in rows)
+
+    @patch('rest.getprices')
+    def test_days_without_prices_are_skipped(self, mock_getprices):
+        """Test that days the upstream has no prices for are left out."""
+        mock_getprices.side_effect = lambda day, gln_number: [] if day.day == 1 else historical_prices(day, gln_number)
+
+        rows = runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 2), [60])
+        assert [row['date'] for row in rows] == ["2024-01-02"]
+
+        # Days without prices are cached too, so they aren't refetched on every backtest
+        runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 2), [60])
+        assert mock_getprices.call_count == 3
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    def test_run_backtest_from_start_hour(self, mock_getprices):
+        """Test that the baseline and the optimum start at startHour and may run into the next day."""
+        # 23:00 local time is 22:00 UTC: two cheap slots are left, then an expensive morning
+        rows = runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 1), [180], startHour=23)
+
+        assert len(rows) == 1
+        row = rows[0]
+        assert datetime.fromisoformat(row['baselineStart']) == datetime.fromisoformat("2024-01-01T22:00:00Z")
+        assert abs(row['impatientCost'] - (0.2 + 0.2 + 1.0)) < 1e-9
+        # The cheapest three hours are the next afternoon
+        assert datetime.fromisoformat(row['fromTs']) == datetime.fromisoformat("2024-01-02T12:00:00Z")
+        assert abs(row['optimalCost'] - 0.6) < 1e-9
+
+        # Starting in the afternoon, the baseline is already the optimum
+        rows = runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 1), [60], startHour=14)
+        assert datetime.fromisoformat(rows[0]['fromTs']) == datetime.fromisoformat("2024-01-01T13:00:00Z")
+        assert abs(rows[0]['savings']) < 1e-9
+
+    @patch('rest.getprices')
+    def test_gln_without_prices_is_probed_once(self, mock_getprices):
+        """Test that a GLN number without prices is rejected after a single upstream call."""
+        mock_getprices.return_value = []
+
+        with pytest.raises(HTTPException) as exc_info:
+            runBacktest("000000000", date(2024, 1, 1), date(2024, 12, 31), [60])
+
+        assert exc_info.value.status_code == 400
+        assert mock_getprices.call_count == 1
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    def test_new_gln_costs_one_token(self, mock_getprices):
+        """Test that a backtest for a new GLN takes one token from the new-GLN cap, not one per day."""
+        bucket = TokenBucket(0.0001, 2)
+
+        with patch('rest.uncachedGlnBucket', bucket):
+            runBacktest("123456789", date(2024, 1, 1), date(2024, 1, 10), [60])
+
+        assert bucket.tokens == pytest.approx(1, abs=0.01)
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    @patch('rest.clientBurst', 1)
+    @patch('rest.clientRatePerSecond', 0.01)
+    def test_backtest_rate_limited(self, mock_getprices, client):
+        """Test that the backtest endpoints share the client token bucket."""
+        url = "/api/backtest?glnNumber=5790000611003&fromDate=2024-01-01&toDate=2024-01-02"
+
+        assert client.get(url).status_code == 200
+        response = client.get(url.replace("/api/backtest", "/api/backtest.csv"))
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) > 0
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    def test_backtest_sheds_load_when_queue_is_full(self, mock_getprices, client):
+        """Test that backtests are rejected with 503 when no slot or queue position is available."""
+        with patch('rest.backtestAdmission', AdmissionController(0, 0)):
+            response = client.get("/api/backtest?glnNumber=5790000611003&fromDate=2024-01-01&toDate=2024-01-02")
+
+        assert response.status_code == 503
+        assert mock_getprices.call_count == 0
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    def test_backtest_summary_endpoint(self, mock_getprices, client):
+        """Test /api/backtest summarises savings per duration."""
+        response = client.get(
+            "/api/backtest?glnNumber=5790000611003&fromDate=2024-01-01&toDate=2024-01-02&durations=1h0m,2h0m"
+        )
+
+        assert response.status_code == 200
+        summary = response.json()['summary']
+        assert [s['duration'] for s in summary] == ["1h0m", "2h0m"]
+        assert "00:00" in response.json()['baseline']
+        assert summary[0]['numDays'] == 2
+        assert abs(summary[0]['savings'] - 1.6) < 1e-9
+        assert abs(summary[0]['savingsPercent'] - 80.0) < 1e-9
+        assert abs(summary[1]['impatientCost'] - 4.0) < 1e-9
+
+    @patch('rest.getprices', side_effect=historical_prices)
+    def test_backtest_csv_endpoint(self, mock_getprices, client):
+        """Test /api/backtest.csv exports one row per day and duration."""
+        response = client.get("/api/backtest.csv?glnNumber=5790000611003&fromDate=2024-01-01&toDate=2024-01-02&durations=1h0m")
+
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/csv')
+        lines = response.text.strip().splitlines()
+        assert lines[0] == "date,duration,baselineStart,fromTs,toTs,optimalCost,impatientCost,savings"
+        assert len(lines) == 3
+        assert lines[1].startswith("2024-01-01,1h0m,2024-01-01T00:00:00+00:00,")
+
+        response = client.get(
+            "/api/backtest.csv?glnNumber=5790000611003&fromDate=2024-01-01&toDate=2024-01-01&durations=1h0m&startHour=14"
+        )
+        assert response.text.strip().splitlines()[1].startswith("2024-01-01,1h0m,2024-01-01T13:00:00+00:00,")
+
+    def test_backtest_invalid_requests(self, client):
+        """Test that invalid ranges and durations are rejected."""
+        base = "/api/backtest?glnNumber=5790000611003"
+
+        response = client.get(f"{base}&fromDate=2024-01-02&toDate=2024-01-01")
+        assert response.status_code == 400
+        assert "toDate must not be before fromDate" in response.json()["detail"]
+
+        response = client.get(f"{base}&fromDate=2024-13-01&toDate=2024-01-01")
+        assert response.status_code == 400
+        assert "Invalid date format" in response.json()["detail"]
+
+        response = client.get(f"{base}&fromDate=2020-01-01&toDate=2024-01-01")
+        assert response.status_code == 400
+        assert "limited to" in response.json()["detail"]
+
+        response = client.get(f"{base}&fromDate=2024-01-01&toDate=2024-01-01&durations=two hours")
+        assert response.status_code == 400
+        assert "Invalid duration" in response.json()["detail"]
+
+        response = client.get(f"{base}&fromDate=2024-01-01&toDate=2024-01-01&startHour=24")
+        assert response.status_code == 400
+        assert "startHour" in response.json()["detail"]